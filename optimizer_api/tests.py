@@ -1,3 +1,194 @@
-from django.test import TestCase
+from unittest import mock
+from django.test import SimpleTestCase
+import numpy as np
+import pandas as pd
+import shapely
+import os
 
-# Create your tests here.
+from .utils import maps
+from .utils.maps import (
+    BOUNDARY_CELL,
+    ROUTE_MAX_SEGMENT_LENGTH,
+    STATE_GRID_CELL_SIZE,
+    build_spatial_index,
+    decode_polyline,
+    get_states_crossed,
+    simplify_route,
+)
+from .utils.optimizer import (
+    InfeasiblePlanError,
+    MAXIMUM_DETOUR,
+    MILES_PER_DEGREE,
+    TANK_CAPACITY,
+    allocate_fuel,
+    min_detours,
+    refuel_optimizer,
+    required_fuel,
+)
+
+
+class SimplifyRouteTests(SimpleTestCase):
+    def setUp(self):
+        # A straight 3-degree east-west stretch (~160 miles) sampled every 0.01 degrees
+        self.route = [[lon, 41.0] for lon in np.linspace(-101.5, -98.5, 301)]
+
+    def test_caps_vertex_spacing(self):
+        simplified = np.asarray(simplify_route(self.route))
+
+        spacing = np.hypot(*np.diff(simplified, axis=0).T)
+        self.assertLess(len(simplified), len(self.route))
+        self.assertLessEqual(spacing.max(), ROUTE_MAX_SEGMENT_LENGTH + 1e-9)
+        np.testing.assert_allclose(simplified[[0, -1]], np.asarray(self.route)[[0, -1]])
+
+    def test_station_beside_segment_midpoint_stays_close(self):
+        simplified = np.ascontiguousarray(simplify_route(self.route), dtype=np.float32)
+
+        # A station half a mile north of the middle of the straight stretch
+        station = np.array([[-100.0, 41.0 + 0.5 / 69.0]], dtype=np.float32)
+        candidates = np.arange(len(simplified), dtype=np.int64).reshape(1, -1)
+        detour = min_detours(simplified, station, candidates)[0][0]
+
+        self.assertLess(detour, 2.0)
+        self.assertLess(detour, MAXIMUM_DETOUR)
+
+
+class AllocateFuelTests(SimpleTestCase):
+    def test_detour_cost_outweighs_small_price_gap(self):
+        # One tank's worth of fuel is needed; the cheaper station is a full detour away
+        distance = 895
+        price_per_gallon = np.array([3.00, 3.20])
+        detour_distances = np.array([MAXIMUM_DETOUR, 0.0])
+
+        gallons = allocate_fuel(price_per_gallon, detour_distances, distance)
+
+        self.assertAlmostEqual(required_fuel(distance), TANK_CAPACITY)
+        np.testing.assert_allclose(gallons, [0.0, TANK_CAPACITY])
+
+    def test_fills_a_tank_at_a_time(self):
+        distance = 2145  # 175 gallons: three full tanks and a partial one
+        price_per_gallon = np.array([3.4, 3.1, 3.3, 3.2, 3.5])
+        detour_distances = np.zeros(5)
+
+        gallons = allocate_fuel(price_per_gallon, detour_distances, distance)
+
+        np.testing.assert_allclose(gallons, [25.0, 50.0, 50.0, 50.0, 0.0])
+        self.assertAlmostEqual(gallons.sum(), required_fuel(distance))
+
+    def test_raises_when_stations_cannot_cover_route(self):
+        with self.assertRaises(InfeasiblePlanError):
+            allocate_fuel(np.array([3.0, 3.1]), np.zeros(2), 2000)
+
+
+class GetStatesCrossedTests(SimpleTestCase):
+    def setUp(self):
+        self.spatial_index = build_spatial_index(
+            os.path.dirname(os.path.abspath(maps.__file__))
+            + "/statics/us_states.geojson"
+        )
+
+    def polygon_states_crossed(self, route):
+        """Reference lookup testing every point against every state polygon."""
+        traversed_states = []
+        for lon, lat in route:
+            for state, geometry in zip(
+                self.spatial_index["states"], self.spatial_index["geometries"]
+            ):
+                if shapely.contains_xy(geometry, lon, lat):
+                    if not traversed_states or traversed_states[-1] != state:
+                        traversed_states.append(state)
+                    break
+        return traversed_states
+
+    def grid_cells(self, route):
+        origin_x, origin_y = self.spatial_index["grid_origin"]
+        points = np.asarray(route)
+        column = np.floor((points[:, 0] - origin_x) / STATE_GRID_CELL_SIZE)
+        row = np.floor((points[:, 1] - origin_y) / STATE_GRID_CELL_SIZE)
+        return self.spatial_index["grid"][row.astype(int), column.astype(int)]
+
+    def test_route_inside_interior_cells(self):
+        # Stays well inside central Texas
+        route = [[lon, 31.0] for lon in np.linspace(-100.5, -98.5, 41)]
+
+        self.assertTrue((self.grid_cells(route) >= 0).all())
+        self.assertEqual(get_states_crossed(route), ["TX"])
+        self.assertEqual(get_states_crossed(route), self.polygon_states_crossed(route))
+
+    def test_route_through_boundary_cells(self):
+        # Crosses the Kansas-Missouri line along I-70
+        route = [[lon, 38.95] for lon in np.linspace(-96.5, -92.5, 81)]
+
+        self.assertIn(BOUNDARY_CELL, self.grid_cells(route))
+        self.assertEqual(get_states_crossed(route), ["KS", "MO"])
+        self.assertEqual(get_states_crossed(route), self.polygon_states_crossed(route))
+
+
+class DecodePolylineTests(SimpleTestCase):
+    def decode(self, encoded, precision):
+        return decode_polyline(np.frombuffer(encoded, np.uint8), precision)
+
+    def test_reference_polyline(self):
+        coords = self.decode(b"_p~iF~ps|U_ulLnnqC_mqNvxq`@", 1e5)
+
+        np.testing.assert_allclose(
+            coords, [[-120.2, 38.5], [-120.95, 40.7], [-126.453, 43.252]]
+        )
+
+    def test_reference_polyline6(self):
+        # The same points encoded with six decimal places
+        coords = self.decode(b"_izlhA~rlgdF_{geC~ywl@_kwzCn`{nI", 1e6)
+
+        np.testing.assert_allclose(
+            coords, [[-120.2, 38.5], [-120.95, 40.7], [-126.453, 43.252]]
+        )
+
+    def test_empty_polyline(self):
+        self.assertEqual(self.decode(b"", 1e6).shape, (0, 2))
+
+    def test_rejects_truncated_polyline(self):
+        with self.assertRaises(ValueError):
+            self.decode(b"_p~iF~ps|U_ulL", 1e5)
+
+    def test_rejects_invalid_character(self):
+        with self.assertRaises(ValueError):
+            self.decode(b"_p~iF ps|U", 1e5)
+
+    def test_rejects_overlong_value(self):
+        # "_" is a continuation byte with an empty payload, so the shift keeps growing
+        with self.assertRaises(ValueError):
+            self.decode(b"_" * 20 + b"??", 1e5)
+
+
+class RefuelOptimizerTests(SimpleTestCase):
+    def stations_east_of_route(self, detours, prices):
+        """Stations the given taxicab miles due east of the route at 48N."""
+        miles_per_lon_degree = MILES_PER_DEGREE * np.cos(np.radians(48.0))
+        coordinates = np.array(
+            [[-100.0 + miles / miles_per_lon_degree, 48.0] for miles in detours]
+        )
+        data = pd.DataFrame(
+            {
+                "Truckstop Name": [f"{miles} MILES EAST" for miles in detours],
+                "Address": ["I-94"] * len(detours),
+                "State": ["ND"] * len(detours),
+                "Retail Price": prices,
+            }
+        )
+        return data, coordinates
+
+    def test_corridor_keeps_stations_within_detour_limit_only(self):
+        # A north-south route through 48N, and one station either side of the limit.
+        # 29 miles east is ~0.63 degrees, beyond an unwidened sqrt(2) * 30 / 69 ~ 0.61
+        # degree radius; the far station is cheaper, so it would win if it were kept
+        route = [[-100.0, lat] for lat in np.linspace(47.5, 48.5, 21)]
+        route_data = {"route": route, "distance": 495}  # 10 gallons needed
+
+        with mock.patch(
+            "optimizer_api.utils.optimizer.load_stations",
+            return_value=self.stations_east_of_route([29, 31], [3.0, 2.0]),
+        ):
+            result = refuel_optimizer(route_data, ["ND"])
+
+        stops = list(result["refuel stops"])
+        self.assertEqual([stop["station"] for stop in stops], ["29 MILES EAST"])
+        self.assertAlmostEqual(stops[0]["fuel"], 10.0)
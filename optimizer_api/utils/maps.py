@@ -1,19 +1,87 @@
 import logging
 from typing import List, Dict, Union
 from geopy.geocoders import Nominatim
-from shapely.geometry import shape, box, Point
+from geopy.extra.rate_limiter import RateLimiter
+from shapely.geometry import box, LineString
+from shapely.strtree import STRtree
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import time
 from numba import njit
-from requests import get
-from json import load
+import shapely
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import requests
+import orjson
 import geopandas as gpd
 import numpy as np
 import folium
+from folium.plugins import FastMarkerCluster
 import os
 
 METER_TO_MILE_FACTOR = 0.000621371
+OSRM_URL = "https://router.project-osrm.org/route/v1/driving"
+POLYLINE_PRECISION = 1e6  # OSRM "polyline6" geometries encode 6 decimal places
+OSRM_TABLE_URL = "https://router.project-osrm.org/table/v1/driving"
+OSRM_TABLE_CHUNK = 50  # destinations per table request, keeping under the server's size limit
+REQUEST_TIMEOUT = 10  # seconds
+USER_AGENT = "trip_optimizer (https://github.com/amgawishx/trip_optimizer)"
+# The public OSRM demo server allows about 1 request per second; only lower this
+# when OSRM_URL and OSRM_TABLE_URL point at a self-hosted instance
+OSRM_MIN_DELAY = 1.0  # seconds between OSRM requests
+# The public Nominatim usage policy allows at most 1 request per second; only lower
+# this when pointing the geocoder at a self-hosted or commercial instance
+GEOCODER_MIN_DELAY = 1.0  # seconds between geocoding requests
+ROUTE_MAX_SEGMENT_LENGTH = 0.05  # degrees (~3.5 miles) between simplified route vertices
+MARKER_CLUSTER_THRESHOLD = 50  # markers drawn individually before clustering
+# Degrees per side of a state lookup grid cell (~55 km). The states' bounds span
+# the antimeridian and the territories, so a ~5 km grid would need ~12M cells at
+# startup; this one needs ~120k, and boundary cells fall back to polygon tests
+STATE_GRID_CELL_SIZE = 0.5
+OUTSIDE_CELL = -1  # grid cell that touches no state
+BOUNDARY_CELL = -2  # grid cell that crosses a state boundary
+
+# Share one pooled HTTP session and geocoder across requests to reuse connections
+_SESSION = requests.Session()
+_SESSION.headers["User-Agent"] = USER_AGENT
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504]),
+    ),
+)
+_GEOCODER = Nominatim(user_agent="geodecode", timeout=REQUEST_TIMEOUT)
+_OSRM_LOCK = Lock()
+_OSRM_LAST_REQUEST = [0.0]  # monotonic time of the last OSRM request
+_GEOCODE = RateLimiter(
+    _GEOCODER.geocode,
+    min_delay_seconds=GEOCODER_MIN_DELAY,
+    max_retries=0,  # fail fast instead of sleeping through retries on the request thread
+    swallow_exceptions=False,
+)
+
+
+def osrm_get(query: str) -> requests.Response:
+    """
+    Sends a GET request to OSRM over the pooled session, spaced OSRM_MIN_DELAY apart.
+
+    Args:
+        query (str): The full OSRM query URL.
 
-# Configure logging with different levels
-logging.basicConfig(level=logging.INFO)
+    Returns:
+        requests.Response: The raw OSRM response.
+    """
+    # Reserve the next request slot under the lock so concurrent callers queue up
+    with _OSRM_LOCK:
+        wait = _OSRM_LAST_REQUEST[0] + OSRM_MIN_DELAY - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        _OSRM_LAST_REQUEST[0] = time.monotonic()
+
+    return _SESSION.get(query, timeout=REQUEST_TIMEOUT)
 
 
 def get_coordinates(address: str) -> List[float]:
@@ -27,13 +95,9 @@ def get_coordinates(address: str) -> List[float]:
     """
     logger = logging.getLogger(__name__)
 
-    # Initialize the geocoder
-    logger.debug("Initializing geocoder")
-    geolocator = Nominatim(user_agent="geodecode", timeout=10)
-
-    # Geocode the address and return the coordinates
+    # Geocode the address through the shared rate limiter and return the coordinates
     try:
-        location = geolocator.geocode(address)
+        location = _GEOCODE(address)
         logger.info(f"Geocoded successfully: {location}")
         return [location.longitude, location.latitude]
     except Exception as e:
@@ -42,9 +106,10 @@ def get_coordinates(address: str) -> List[float]:
 
 def get_route_data(
     start_address: str, end_address: str
-) -> Dict[str, Union[List[List[float]], float]]:
+) -> Dict[str, Union[np.ndarray, float]]:
     """
     Retrieves route data between two addresses.
+    The route geometry is an (N, 2) array of [longitude, latitude] pairs.
 
     Args:
         start_address (str): The starting address for the route.
@@ -56,60 +121,221 @@ def get_route_data(
     logger = logging.getLogger(__name__)
 
     try:
+        # The rate limiter serializes geocodes anyway, so only overlap the two round
+        # trips when the delay has been lowered for a self-hosted geocoder
+        if GEOCODER_MIN_DELAY > 0:
+            start_location = get_coordinates(start_address)
+            end_location = get_coordinates(end_address)
+        else:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                start_future = executor.submit(get_coordinates, start_address)
+                end_future = executor.submit(get_coordinates, end_address)
+                start_location = start_future.result()
+                end_location = end_future.result()
+
+        if start_location is None or end_location is None:
+            raise Exception("Could not geocode route addresses")
+
+        # OSRM expects "longitude,latitude" pairs
+        start_coord = ",".join(map(str, start_location))
+        end_coord = ",".join(map(str, end_location))
+
         # Build the query URL for the OSRM API
-        query = f"{osrm_url}/{start_coord};{end_coord}?overview=full&geometries=geojson"
+        query = f"{OSRM_URL}/{start_coord};{end_coord}?overview=full&geometries=polyline6"
 
-        # Send the request to the OSRM API
-        response = get(query).json()
+        # Send the request to the OSRM API over the pooled, throttled session
+        response = osrm_get(query)
+        response.raise_for_status()
+        response = orjson.loads(response.content)
 
-        if "error" in response:
-            logger.error(f"API Error: {response['error']}")
+        if response.get("code") != "Ok":
+            logger.error(f"API Error: {response.get('message', response.get('code'))}")
             raise Exception("OSRM API returned error")
 
         route_data = {
-            "route": route_geometry,
+            "route": decode_polyline(
+                np.frombuffer(response["routes"][0]["geometry"].encode(), np.uint8),
+                POLYLINE_PRECISION,
+            ),
             "distance": response["routes"][0]["distance"] * METER_TO_MILE_FACTOR,
         }
 
         return route_data
-    except requests.exceptions.RequestException as e:
+    except (
+        requests.exceptions.RequestException,
+        orjson.JSONDecodeError,
+        ValueError,  # malformed route geometry from decode_polyline
+    ) as e:
         logger.error(
             f"Request failed for addresses {start_address}-{end_address}: {str(e)}"
         )
         raise
 
 
-@njit
-def calculate_route_distance(coord1: np.ndarray, coord2: np.ndarray) -> float:
+@njit(cache=True)
+def decode_polyline(encoded: np.ndarray, precision: float) -> np.ndarray:
     """
-    Calculate the taxicab (Manhattan) distance in miles between two geographical coordinates.
+    Decodes an encoded polyline straight into a coordinate array.
 
-    INFO: Performs calculations based on latitude and longitude.
+    Args:
+        encoded (np.ndarray): The polyline's ASCII bytes as a uint8 array.
+        precision (float): Scale the coordinates were encoded with (1e5 for polyline, 1e6 for polyline6).
+
+    Returns:
+        np.ndarray: (N, 2) array of [longitude, latitude] pairs.
+
+    ERROR: Raises ValueError on a truncated polyline, a byte outside its alphabet,
+    or a value too long for 64 bits.
     """
-    logger = logging.getLogger(__name__)
+    # Every coordinate takes at least one byte, so this bounds the number of points
+    coords = np.empty((len(encoded) // 2, 2))
+    values = np.zeros(2, dtype=np.int64)  # running latitude, longitude
+    index = 0
+    count = 0
+
+    while index < len(encoded):
+        # Each point stores the latitude then the longitude delta
+        for axis in range(2):
+            result = 0
+            shift = 0
+            while True:
+                if index >= len(encoded):
+                    raise ValueError("Truncated polyline")
+                if shift > 60:
+                    raise ValueError("Polyline value overflows 64 bits")
+                chunk = np.int64(encoded[index]) - 63
+                if chunk < 0 or chunk > 0x3F:
+                    raise ValueError("Invalid polyline character")
+                index += 1
+                result |= (chunk & 0x1F) << shift
+                shift += 5
+                if chunk < 0x20:
+                    break
+            values[axis] += ~(result >> 1) if result & 1 else result >> 1
 
-    try:
-        # Constants for conversion
-        lat_miles = 69.0  # 1 degree of latitude is approximately 69 miles
-        avg_latitude = (coord1[0] + coord2[0]) / 2
+        # Store as [longitude, latitude] like the GeoJSON geometry
+        coords[count, 0] = values[1] / precision
+        coords[count, 1] = values[0] / precision
+        count += 1
 
-        lon_miles = 69.0 * np.cos(
-            np.radians(avg_latitude)
-        )  # Adjust longitude to miles based on latitude
+    return coords[:count]
 
-        distance = lat_miles * abs(coord1[0] - coord2[0]) + lon_miles * abs(
-            coord1[1] - coord2[1]
+
+def get_road_distances(origins: np.ndarray, destinations: np.ndarray) -> np.ndarray:
+    """
+    Retrieves driving distances from each origin to its destination with the OSRM table service.
+
+    Args:
+        origins (np.ndarray): (M, 2) array of [longitude, latitude] origins.
+        destinations (np.ndarray): (M, 2) array of [longitude, latitude] destinations.
+
+    Returns:
+        np.ndarray: (M,) array of road distances in miles, infinite where no route exists.
+
+    WARNING: Could not retrieve distances due to API error.
+    """
+    def get_chunk(start: int) -> np.ndarray:
+        return _get_road_distances_chunk(
+            origins[start : start + OSRM_TABLE_CHUNK],
+            destinations[start : start + OSRM_TABLE_CHUNK],
         )
-        logger.debug(f"Calculated distance: {distance} miles")
 
-        return abs(distance)
-    except Exception as e:
-        logger.error(
-            f"Error in calculate_route_distance for coordinates {coord1}-{coord2}: {str(e)}"
+    # The chunks only overlap when OSRM is not throttled (a self-hosted instance);
+    # against the public server they are sent one after the other
+    starts = range(0, len(destinations), OSRM_TABLE_CHUNK)
+    if OSRM_MIN_DELAY > 0:
+        chunks = [get_chunk(start) for start in starts]
+    else:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            chunks = list(executor.map(get_chunk, starts))
+
+    return np.concatenate(chunks) if chunks else np.empty(0)
+
+
+def _get_road_distances_chunk(
+    origins: np.ndarray, destinations: np.ndarray
+) -> np.ndarray:
+    """
+    Retrieves one OSRM table request worth of origin-destination distances.
+
+    Args:
+        origins (np.ndarray): (K, 2) array of [longitude, latitude] origins.
+        destinations (np.ndarray): (K, 2) array of [longitude, latitude] destinations.
+
+    Returns:
+        np.ndarray: (K,) array of road distances in miles.
+    """
+    logger = logging.getLogger(__name__)
+
+    # Send each distinct origin only once, destinations follow the origins
+    sources, source_of = np.unique(origins, axis=0, return_inverse=True)
+    source_of = source_of.reshape(-1)
+    points = ";".join(f"{lon},{lat}" for lon, lat in np.vstack((sources, destinations)))
+    source_ids = ";".join(map(str, range(len(sources))))
+    destination_ids = ";".join(
+        map(str, range(len(sources), len(sources) + len(destinations)))
+    )
+
+    # Build the query URL for the OSRM table API
+    query = (
+        f"{OSRM_TABLE_URL}/{points}?annotations=distance"
+        f"&sources={source_ids}&destinations={destination_ids}"
+    )
+
+    try:
+        # Send the request to the OSRM API over the pooled, throttled session
+        response = osrm_get(query)
+        response.raise_for_status()
+        response = orjson.loads(response.content)
+
+        if response.get("code") != "Ok":
+            logger.error(f"API Error: {response.get('message', response.get('code'))}")
+            raise Exception("OSRM table API returned error")
+
+        # Unreachable pairs come back as null distances
+        distances = np.array(response["distances"], dtype=np.float64)
+        distances = np.where(np.isnan(distances), np.inf, distances)
+
+        # Pick each destination's distance from its own origin
+        return (
+            distances[source_of, np.arange(len(destinations))] * METER_TO_MILE_FACTOR
         )
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        logger.error(f"Table request failed for {len(destinations)} stations: {str(e)}")
         raise
 
 
+def simplify_route(
+    route: List[List[float]], tolerance: float = 0.01
+) -> List[List[float]]:
+    """
+    Downsamples a route geometry by dropping near-collinear vertices.
+
+    The detour and state searches only look at route vertices, so long straight
+    segments are split again until no two vertices are more than
+    ROUTE_MAX_SEGMENT_LENGTH apart.
+
+    Args:
+        route (List[List[float]]): List of coordinate pairs for the route.
+        tolerance (float, optional): Maximum deviation (in degrees) of the simplified route. Default is 0.01.
+
+    Returns:
+        List[List[float]]: The simplified list of coordinate pairs.
+    """
+    # A route of fewer than two points cannot be simplified as a line
+    if len(route) < 2:
+        return route
+
+    # Simplify the polyline; the endpoints are always kept
+    simplified = LineString(route).simplify(tolerance, preserve_topology=False)
+
+    # Cap the vertex spacing so stations beside a long straight stretch stay near a vertex
+    simplified = shapely.segmentize(
+        simplified, max_segment_length=ROUTE_MAX_SEGMENT_LENGTH
+    )
+    return [list(coord) for coord in simplified.coords]
+
+
 def generate_map(
     route: List[List[float]],
     markers: List[List[float]] = None,
@@ -124,14 +350,24 @@ def generate_map(
     logger = logging.getLogger(__name__)
 
     try:
-        # Reverse coordinates for Folium compatibility
-        reversed_route = [[lat, lon] for [lon, lat] in route]
+        # Reverse coordinates for Folium compatibility in one array operation
+        reversed_route = np.asarray(route, dtype=np.float64)[:, ::-1].tolist()
+
+        map_route = folium.Map(location=reversed_route[0])
+        folium.PolyLine(reversed_route).add_to(map_route)
 
         if markers is not None:
-            reversed_markers = [marker[::-1] for marker in markers]
+            reversed_markers = np.asarray(markers, dtype=np.float64).reshape(-1, 2)
+            reversed_markers = reversed_markers[:, ::-1].tolist()
 
-        map_route = folium.Map(location=reversed_route[0])
-        return map_route  # This will raise an exception if called without a valid route
+            # Many markers are serialized as a single JSON blob instead of one template each
+            if len(reversed_markers) > MARKER_CLUSTER_THRESHOLD:
+                FastMarkerCluster(reversed_markers).add_to(map_route)
+            else:
+                for marker in reversed_markers:
+                    folium.Marker(marker).add_to(map_route)
+
+        return map_route
     except Exception as e:
         logger.error(f"Error generating map: {str(e)}")
         raise
@@ -158,36 +394,60 @@ def simplify_state_geometries(states_geojson: str, tolerance: float) -> Dict:
     return states
 
 
+@lru_cache(maxsize=1)
 def build_spatial_index(states_geojson: str) -> Dict:
     """
-    Builds a spatial index for states using their bounding boxes and simplified geometries.
+    Builds a spatial index for states using an R-tree over their simplified geometries,
+    plus a uniform lat/lon grid mapping each cell to the single state containing it.
+    The index is request-invariant, so it is built once per path and cached.
 
     Args:
         states_geojson (str): Path to the GeoJSON file containing state boundaries.
 
     Returns:
-        Dict: Spatial index with state names, bounding boxes, and simplified geometries.
+        Dict: Spatial index with state names, prepared geometries, the STRtree over them and the state grid.
     """
     # Simplify the state geometries for better performance
     simplified_geojson = simplify_state_geometries(states_geojson, tolerance=0.1)
 
-    # Initialize an empty dictionary to hold the spatial index
-    spatial_index = {}
-
-    # Iterate through each state's geometry
-    for _, row in simplified_geojson.iterrows():
-        state_name = row["abbr"]  # Extract the state's abbreviation
-        geometry = row["geometry"]  # Extract the state's geometry
-        bounding_box = geometry.bounds  # Calculate the bounding box for the geometry
+    # Extract the states' abbreviations and geometries in matching order
+    states = simplified_geojson["abbr"].tolist()
+    geometries = np.array(simplified_geojson["geometry"].tolist(), dtype=object)
+
+    # Prepare the geometries in place so containment tests reuse their internal index
+    shapely.prepare(geometries)
+    tree = STRtree(geometries)
+
+    # Lay a uniform grid of cells over all the states
+    min_x, min_y, max_x, max_y = simplified_geojson.total_bounds
+    columns = int(np.ceil((max_x - min_x) / STATE_GRID_CELL_SIZE))
+    rows = int(np.ceil((max_y - min_y) / STATE_GRID_CELL_SIZE))
+    cell_x, cell_y = np.meshgrid(
+        min_x + STATE_GRID_CELL_SIZE * np.arange(columns),
+        min_y + STATE_GRID_CELL_SIZE * np.arange(rows),
+    )
+    cells = shapely.box(
+        cell_x.ravel(),
+        cell_y.ravel(),
+        cell_x.ravel() + STATE_GRID_CELL_SIZE,
+        cell_y.ravel() + STATE_GRID_CELL_SIZE,
+    )
 
-        # Add the state's data to the spatial index
-        spatial_index[state_name] = {
-            "geometry": geometry,
-            "bounding_box": box(*bounding_box),
-        }
+    # Cells touching any state need a polygon test, cells inside one state resolve to it
+    grid = np.full(len(cells), OUTSIDE_CELL, dtype=np.int16)
+    touching_cells, _ = tree.query(cells, predicate="intersects")
+    grid[touching_cells] = BOUNDARY_CELL
+    inside_cells, inside_states = tree.query(cells, predicate="within")
+    grid[inside_cells] = inside_states
 
     # Return the constructed spatial index
-    return spatial_index
+    return {
+        "states": states,
+        "geometries": geometries,
+        "tree": tree,
+        "grid": grid.reshape(rows, columns),
+        "grid_origin": (min_x, min_y),
+    }
 
 
 def get_states_crossed(
@@ -203,44 +463,53 @@ def get_states_crossed(
     Returns:
         List[str]: A list of state codes crossed by the route.
     """
-    # Initialize a list to store traversed states
-    traversed_states = []
-
     # Build the spatial index using the provided GeoJSON file
     spatial_index = build_spatial_index(
         os.path.dirname(os.path.abspath(__file__)) + geojson_path
     )
 
-    # Keep track of the current state
-    current_state = None
-
-    # Iterate through each point in the route
-    for point in coordinates:
-        point_geom = Point(point)  # Create a Point geometry for the current coordinate
-        state_found = None  # Reset the state found
-
-        # Check if the point lies in the bounding box of the current state
-        if current_state and spatial_index[current_state]["bounding_box"].contains(
-            point_geom
-        ):
-            # If so, check if it lies within the geometry of the current state
-            if spatial_index[current_state]["geometry"].contains(point_geom):
-                state_found = current_state
-
-        # If the point is not in the current state, search all states
-        if not state_found:
-            for state_code, data in spatial_index.items():
-                # Check if the point lies within the bounding box and geometry
-                if data["bounding_box"].contains(point_geom) and data[
-                    "geometry"
-                ].contains(point_geom):
-                    state_found = state_code
-                    break
+    # Split the route into coordinate arrays once
+    points = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    if not len(points):
+        return []
+    xs, ys = points[:, 0], points[:, 1]
+
+    # Look every point up in the state grid
+    grid = spatial_index["grid"]
+    origin_x, origin_y = spatial_index["grid_origin"]
+    column = np.floor((xs - origin_x) / STATE_GRID_CELL_SIZE).astype(np.int64)
+    row = np.floor((ys - origin_y) / STATE_GRID_CELL_SIZE).astype(np.int64)
+    on_grid = (
+        (column >= 0) & (column < grid.shape[1]) & (row >= 0) & (row < grid.shape[0])
+    )
+    point_states = np.full(len(points), OUTSIDE_CELL, dtype=np.int64)
+    point_states[on_grid] = grid[row[on_grid], column[on_grid]]
 
-        # Add the state to the list if it has changed
-        if state_found and state_found != current_state:
-            traversed_states.append(state_found)
-            current_state = state_found
+    # Resolve the points in boundary cells with the polygon tests
+    boundary = point_states == BOUNDARY_CELL
+    if boundary.any():
+        boundary_xs, boundary_ys = xs[boundary], ys[boundary]
+
+        # Only test the states whose bounding box meets these points' bounding box
+        points_box = box(
+            boundary_xs.min(), boundary_ys.min(), boundary_xs.max(), boundary_ys.max()
+        )
+        candidates = np.sort(spatial_index["tree"].query(points_box))
+
+        # Assign each point to the first candidate state containing it
+        boundary_states = np.full(len(boundary_xs), OUTSIDE_CELL, dtype=np.int64)
+        for candidate in candidates:
+            contained = shapely.contains_xy(
+                spatial_index["geometries"][candidate], boundary_xs, boundary_ys
+            )
+            boundary_states[contained & (boundary_states == OUTSIDE_CELL)] = candidate
+        point_states[boundary] = boundary_states
+
+    # Drop points outside every state and keep only the state transitions
+    point_states = point_states[point_states >= 0]
+    if not len(point_states):
+        return []
+    transitions = np.concatenate(([True], np.diff(point_states) != 0))
 
     # Return the list of traversed states
-    return traversed_states
+    return [spatial_index["states"][i] for i in point_states[transitions]]
@@ -1,7 +1,9 @@
-from typing import List, Dict, Union
-from scipy.optimize import minimize
-from .maps import calculate_route_distance
-from numba import njit
+from typing import List, Dict, Tuple, Union
+import logging
+from functools import lru_cache
+from scipy.spatial import cKDTree
+from .maps import decode_polyline, get_road_distances, get_states_crossed
+from numba import njit, prange, types
 import numpy as np
 import pandas as pd
 import os
@@ -11,25 +13,112 @@ CAR_RANGE = 500  # miles
 FUEL_EFFICIENCY = 10  # miles / gallon
 ALPHA = 75  # tank allowance before requiring refueling
 MAXIMUM_DETOUR = 30  # assumption of total amount of detour distance to refuel
+TANK_CAPACITY = CAR_RANGE / FUEL_EFFICIENCY  # gallons bought at most per stop
+MILES_PER_DEGREE = 69.0  # 1 degree of latitude is approximately 69 miles
+STATIONS_FILENAME = "/statics/with_cords.csv"  # fuel station data, relative to this module
+NEAREST_ROUTE_POINTS = 8  # route points (by degree distance) checked per station
 
 
-@njit
-def find_closest_distance(route: np.ndarray, coord: np.ndarray) -> float:
+class InfeasiblePlanError(ValueError):
     """
-    Finds the closest distance between a given coordinate and a route.
+    Raised when the stations along a route cannot supply the fuel the route needs.
+    """
+
+
+def parse_coordinates(coordinates: pd.Series) -> np.ndarray:
+    """
+    Parses "[longitude, latitude]" strings into a coordinate array.
 
     Args:
-        route (np.ndarray): Array of [latitude, longitude] pairs representing the route.
-        coord (np.ndarray): [latitude, longitude] coordinate to compare.
+        coordinates (pd.Series): Series of coordinate pair strings.
 
     Returns:
-        float: The shortest distance in miles between the route and the coordinate.
+        np.ndarray: (M, 2) array of float coordinate pairs.
+    """
+    # Strip the brackets and split on the comma instead of evaluating each literal
+    return (
+        coordinates.str.strip("[]")
+        .str.split(",", expand=True)
+        .to_numpy(dtype=np.float64)
+        .reshape(-1, 2)
+    )
+
+
+@lru_cache(maxsize=1)
+def load_stations(data_filename: str) -> Tuple[pd.DataFrame, np.ndarray]:
     """
-    # Calculate the distance from the given coordinate to each point in the route
-    return min([calculate_route_distance(i, coord) for i in route])
+    Loads the fuel station data and parses its coordinates, cached per path.
 
+    Args:
+        data_filename (str): Path to the CSV file with fuel station data.
+
+    Returns:
+        Tuple[pd.DataFrame, np.ndarray]: Stations with missing data dropped, and their (M, 2) coordinates.
+    """
+    # Load the fuel station data and drop rows with missing data
+    data = pd.read_csv(data_filename).dropna().drop_duplicates()
+
+    # Parse the coordinates once so every request can reuse them
+    return data, parse_coordinates(data["Coordinates"])
+
+
+@njit(
+    types.Tuple((types.float32[::1], types.int64[::1]))(
+        types.float32[:, ::1], types.float32[:, ::1], types.int64[:, ::1]
+    ),
+    parallel=True,
+    cache=True,
+    fastmath=True,
+)
+def min_detours(
+    route: np.ndarray, stations: np.ndarray, candidates: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the closest distance between each station and a route.
+
+    Args:
+        route (np.ndarray): (N, 2) float32 array of [longitude, latitude] pairs representing the route.
+        stations (np.ndarray): (M, 2) float32 array of station [longitude, latitude] pairs.
+        candidates (np.ndarray): (M, K) array, K >= 1, of indices of the route points nearest to each station.
 
-@njit
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (M,) float32 array of the shortest taxicab distances in miles
+        between the route and each station, and (M,) indices of the route points giving them.
+    """
+    # Single precision is ample for mile-level distances and doubles the SIMD width
+    detours = np.empty(stations.shape[0], dtype=np.float32)
+    nearest = np.empty(stations.shape[0], dtype=np.int64)
+    lat_miles = np.float32(MILES_PER_DEGREE)
+    half_lat_miles = np.float32(MILES_PER_DEGREE / 2)
+
+    # Hoist the trigonometry out of the pairwise loop: the cosine of the average
+    # latitude is approximated by the average of the cosines, which is accurate
+    # for the short separations this is used on
+    route_cos = np.cos(np.radians(route[:, 1]))
+    station_cos = np.cos(np.radians(stations[:, 1]))
+
+    # Scan the candidate route points of each station, keeping only the running minimum;
+    # stations are independent and each writes its own slot, so they run in parallel.
+    # fastmath assumes no infinities, so the minimum is seeded from the first candidate
+    for s in prange(stations.shape[0]):
+        best = np.float32(0.0)
+        best_point = candidates[s, 0]
+        for k in range(candidates.shape[1]):
+            r = candidates[s, k]
+            lon_miles = half_lat_miles * (route_cos[r] + station_cos[s])
+            distance = lat_miles * abs(route[r, 1] - stations[s, 1]) + lon_miles * abs(
+                route[r, 0] - stations[s, 0]
+            )
+            if k == 0 or distance < best:
+                best = distance
+                best_point = r
+        detours[s] = best
+        nearest[s] = best_point
+
+    return detours, nearest
+
+
+@njit(cache=True)
 def cost_function(
     gallons: np.ndarray,
     price_per_gallon: np.ndarray,
@@ -50,28 +139,89 @@ def cost_function(
     return sum((gallons + 2 * detour_distances / FUEL_EFFICIENCY) * price_per_gallon)
 
 
-@njit
-def constraint(gallons: np.ndarray, distance: float) -> float:
+def required_fuel(distance: float) -> float:
     """
-    Defines the inequality constraint for the optimization problem.
+    Computes the fuel that has to be bought along a route.
 
     Args:
-        gallons (np.ndarray): Amount of fuel (in gallons) to purchase at each station.
         distance (float): Total route distance in miles.
 
     Returns:
-        float: Remaining fuel after considering distance and constraints.
+        float: Gallons needed beyond the initial tank, including the detour and allowance.
     """
-    # Ensure total fuel purchased meets the route requirements with detours
-    return (
-        sum(gallons) - (distance + MAXIMUM_DETOUR - CAR_RANGE + ALPHA) / FUEL_EFFICIENCY
+    # Fuel for the route with detours, minus what the starting tank covers
+    return (distance + MAXIMUM_DETOUR - CAR_RANGE + ALPHA) / FUEL_EFFICIENCY
+
+
+def allocate_fuel(
+    price_per_gallon: np.ndarray, detour_distances: np.ndarray, distance: float
+) -> np.ndarray:
+    """
+    Distributes the required fuel over the cheapest stations.
+
+    The cost is linear in the gallons bought plus a fixed detour cost per visited
+    station, so stations are ranked by their price with that detour spread over a
+    full tank, and filled up in that order, each limited to one tank.
+
+    Args:
+        price_per_gallon (np.ndarray): Fuel price per gallon at each station.
+        detour_distances (np.ndarray): Detour distances (in miles) to reach each station.
+        distance (float): Total route distance in miles.
+
+    Returns:
+        np.ndarray: Amount of fuel (in gallons) to purchase at each station.
+
+    ERROR: The stations cannot supply enough fuel to cover the route.
+    """
+    logger = logging.getLogger(__name__)
+
+    # Check the stations can cover the route at all before planning
+    needed = required_fuel(distance)
+    if needed > TANK_CAPACITY * len(price_per_gallon):
+        logger.error(
+            f"{len(price_per_gallon)} stations cannot supply {needed:.1f} gallons"
+        )
+        raise InfeasiblePlanError("Not enough fuel stations along the route")
+
+    # Visit the stations from the cheapest effective price to the most expensive
+    effective_price = price_per_gallon * (
+        1 + 2 * detour_distances / (FUEL_EFFICIENCY * TANK_CAPACITY)
     )
+    order = np.argsort(effective_price, kind="stable")
+
+    # Fuel still needed before each station in that order, capped at a full tank
+    still_needed = needed - TANK_CAPACITY * np.arange(len(order))
+    gallons = np.zeros(len(order))
+    gallons[order] = np.clip(still_needed, 0, TANK_CAPACITY)
+
+    return gallons
+
+
+def warm_up() -> None:
+    """
+    Prepares everything the first request would otherwise pay for: compiles the Numba
+    kernels on dummy data, and builds the cached state index and station data.
+    """
+    # Use the same dtypes and layouts as refuel_optimizer so the compiled signatures match
+    route = np.zeros((2, 2), dtype=np.float32)
+    stations = np.zeros((1, 2), dtype=np.float32)
+    candidates = np.zeros((1, 1), dtype=np.int64)
+
+    detours, _ = min_detours(route, stations, candidates)
+    detours = detours.astype(np.float64)
+    cost_function(np.zeros(1), np.zeros(1), detours)
+    decode_polyline(np.frombuffer(b"??", np.uint8), 1e6)
+
+    # Build the lazily cached state grid and station data
+    get_states_crossed([])
+    load_stations(os.path.dirname(os.path.abspath(__file__)) + STATIONS_FILENAME)
 
 
 def refuel_optimizer(
     route_data: dict,
     states_crossed: List[str],
-    data_filename: str = "/statics/with_cords.csv",
+    data_filename: str = STATIONS_FILENAME,
+    road_detours: bool = False,
 ) -> Dict:
     """
     Optimizes the refueling stops and costs along a route.
@@ -80,81 +230,99 @@ def refuel_optimizer(
         route_data (dict): Data containing route geometry and distance.
         states_crossed (List[str]): List of state codes the route crosses.
         data_filename (str, optional): Path to the CSV file with fuel station data. Default is "/statics/with_cords.csv".
+        road_detours (bool, optional): Whether to replace the taxicab detours with OSRM driving distances. Default is False.
 
     Returns:
         Dict: Refueling plan with stops, fuel purchased, and total cost.
     """
-    # Load the fuel station data from the provided CSV file
-    data = pd.read_csv(os.path.dirname(os.path.abspath(__file__)) + data_filename)
-
-    # Filter stations within the states crossed and drop rows with missing data
-    filtered_data = data[data["State"].isin(states_crossed)].dropna().drop_duplicates()
-
-    # Calculate detour distances for each fuel station from the route
-    detour_distances = (
-        np.array(
-            [
-                find_closest_distance(
-                    np.array([np.array(c) for c in route_data["route"]]),
-                    np.array(eval(coord)),
-                )
-                for coord in filtered_data["Coordinates"]
-            ]
+    # Load the (cached) fuel station data from the provided CSV file
+    data, coordinates = load_stations(
+        os.path.dirname(os.path.abspath(__file__)) + data_filename
+    )
+
+    # Filter stations within the states crossed
+    in_states = data["State"].isin(states_crossed).to_numpy()
+    filtered_data = data[in_states]
+    stations_arr = coordinates[in_states]
+
+    # Build the single precision route coordinate array once for the detour kernel
+    route_arr = np.ascontiguousarray(route_data["route"], dtype=np.float32)
+
+    route_tree = cKDTree(route_arr)
+
+    # A station within MAXIMUM_DETOUR taxicab miles is within this many degrees of the
+    # route, using the narrowest longitude degree the corridor can reach
+    max_latitude = np.abs(route_arr[:, 1]).max() + MAXIMUM_DETOUR / MILES_PER_DEGREE
+    corridor = (MAXIMUM_DETOUR / MILES_PER_DEGREE) * np.hypot(
+        1.0, 1.0 / np.cos(np.radians(min(max_latitude, 89.0)))
+    )
+
+    # Drop the stations outside the corridor before the detour computation
+    nearest, _ = route_tree.query(
+        stations_arr, k=1, distance_upper_bound=corridor, workers=-1
+    )
+    in_corridor = np.isfinite(nearest)
+    filtered_data = filtered_data[in_corridor]
+    stations_arr = stations_arr[in_corridor]
+
+    # Find the route points nearest to each remaining station with the KD-tree
+    neighbours = min(NEAREST_ROUTE_POINTS, len(route_arr))
+    _, candidates = route_tree.query(stations_arr, k=neighbours, workers=-1)
+    candidates = np.ascontiguousarray(candidates.reshape(-1, neighbours), dtype=np.int64)
+
+    # Calculate detour distances (in miles) for each fuel station from the route
+    detour_distances, nearest_points = min_detours(
+        route_arr,
+        np.ascontiguousarray(stations_arr, dtype=np.float32),
+        candidates,
+    )
+    detour_distances = detour_distances.astype(np.float64)
+
+    if road_detours:
+        # A road detour is at least the straight line, which is at least the taxicab
+        # distance over sqrt(2), so only those stations can still be within reach
+        reachable = detour_distances <= MAXIMUM_DETOUR * np.sqrt(2)
+        filtered_data = filtered_data[reachable]
+        stations_arr = stations_arr[reachable]
+
+        # Measure the driving distance from the route point closest in taxicab miles
+        detour_distances = get_road_distances(
+            route_arr[nearest_points[reachable]].astype(np.float64), stations_arr
         )
-    ) * 100
+
     # Filter to find the nearest stations to the route
     filtered_data = filtered_data[detour_distances <= MAXIMUM_DETOUR]
+    stations_arr = stations_arr[detour_distances <= MAXIMUM_DETOUR]
     detour_distances = detour_distances[detour_distances <= MAXIMUM_DETOUR]
 
-    # Determine the number of available fuel stations
-    number_of_stations = len(filtered_data)
-
     # Extract fuel prices at each station
     price_per_gallon = np.array(filtered_data["Retail Price"])
 
-    # Define bounds for fuel quantities at each station
-    bounds = [(0, None)] * number_of_stations
-
-    # Define constraints to ensure sufficient fuel for the route
-    constraints = [
-        {
-            "type": "eq",
-            "fun": constraint,
-            "args": (route_data["distance"],),
-        }
-    ]
-
-    # Initialize the fuel quantities evenly across stations
-    initial_guess = [
-        ((route_data["distance"] + ALPHA - CAR_RANGE) / FUEL_EFFICIENCY)
-        / number_of_stations
-    ] * number_of_stations
-    # Perform the optimization to minimize total refueling cost
-    refuel_result = minimize(
-        cost_function,
-        initial_guess,
-        args=(price_per_gallon, detour_distances),
-        constraints=constraints,
-        bounds=bounds,
-        tol=1e-3,
-    )
+    # Fill up at the cheapest stations to minimize total refueling cost
+    gallons = allocate_fuel(price_per_gallon, detour_distances, route_data["distance"])
 
     # Build the result for each fuel station
     result_per_station = [
         {
-            "station": filtered_data["Truckstop Name"].tolist()[i],
-            "fuel": refuel_result.x[i],
-            "address": filtered_data["Address"].tolist()[i],
-            "coordinates": filtered_data["Coordinates"].tolist()[i],
+            "station": station,
+            "fuel": fuel,
+            "address": address,
+            "coordinates": coords,
         }
-        for i in range(len(refuel_result.x))
+        for station, fuel, address, coords in zip(
+            filtered_data["Truckstop Name"].tolist(),
+            gallons.tolist(),
+            filtered_data["Address"].tolist(),
+            stations_arr.tolist(),
+        )
     ]
 
-    # Calculate the total refueling cost
+    # Calculate the total refueling cost over the stations actually visited
+    purchased = np.round(gallons) > 0
     total_refuel_cost = cost_function(
-        np.round(refuel_result.x),
-        price_per_gallon,
-        detour_distances[np.round(refuel_result.x) > 0],
+        np.round(gallons[purchased]),
+        price_per_gallon[purchased],
+        detour_distances[purchased],
     )
 
     # Filter out stations where no fuel was purchased
@@ -1,10 +1,16 @@
 from django.shortcuts import render
 from django.http import HttpResponse
+from django.utils.html import escape
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
-from .utils.maps import get_route_data, generate_map, get_states_crossed
-from .utils.optimizer import refuel_optimizer
+from .utils.maps import (
+    get_route_data,
+    generate_map,
+    get_states_crossed,
+    simplify_route,
+)
+from .utils.optimizer import InfeasiblePlanError, refuel_optimizer
 
 
 @api_view(["GET"])
@@ -16,6 +22,7 @@ def optimize_route_json(request, address1, address2):
         request: The HTTP request object.
         address1 (str): The starting address.
         address2 (str): The ending address.
+        road_detours (query, optional): "true" to measure station detours as OSRM driving distances.
 
     Returns:
         Response: A JSON response containing the optimized route, distance, refuel stops, and total cost.
@@ -23,11 +30,24 @@ def optimize_route_json(request, address1, address2):
     # Retrieve route data including coordinates and distance
     route_data = get_route_data(address1, address2)
 
+    # Downsample the route geometry for the state and detour searches
+    search_route = simplify_route(route_data["route"])
+
     # Identify the states crossed by the route
-    states_crossed = get_states_crossed(route_data["route"])
+    states_crossed = get_states_crossed(search_route)
 
     # Optimize refueling stops and calculate the total cost
-    stops = refuel_optimizer(route_data, states_crossed)
+    try:
+        stops = refuel_optimizer(
+            {**route_data, "route": search_route},
+            states_crossed,
+            road_detours=request.query_params.get("road_detours") == "true",
+        )
+    except InfeasiblePlanError as e:
+        # No feasible refueling plan along this route
+        return Response(
+            {"error": str(e)}, status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
 
     # Build the response body with route data and optimization results
     response_body = {
@@ -50,6 +70,7 @@ def optimize_route_html(request, address1, address2):
         request: The HTTP request object.
         address1 (str): The starting address.
         address2 (str): The ending address.
+        road_detours (query, optional): "true" to measure station detours as OSRM driving distances.
 
     Returns:
         HttpResponse: An HTTP response containing an HTML representation of the route map with refuel stops.
@@ -57,16 +78,29 @@ def optimize_route_html(request, address1, address2):
     # Retrieve route data including coordinates and distance
     route_data = get_route_data(address1, address2)
 
+    # Downsample the route geometry for the state and detour searches
+    search_route = simplify_route(route_data["route"])
+
     # Identify the states crossed by the route
-    states_crossed = get_states_crossed(route_data["route"])
+    states_crossed = get_states_crossed(search_route)
 
     # Optimize refueling stops and calculate the total cost
-    stops = refuel_optimizer(route_data, states_crossed)
+    try:
+        stops = refuel_optimizer(
+            {**route_data, "route": search_route},
+            states_crossed,
+            road_detours=request.query_params.get("road_detours") == "true",
+        )
+    except InfeasiblePlanError as e:
+        # No feasible refueling plan along this route
+        return HttpResponse(
+            f"<p>{escape(str(e))}</p>", status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
 
     # Generate a map with the route and refuel stop markers
     geomap = generate_map(
         route_data["route"],
-        markers=[eval(stop["coordinates"]) for stop in stops["refuel stops"]],
+        markers=[stop["coordinates"] for stop in stops["refuel stops"]],
     )
 
     # Return the map as an HTML response
@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'trip_optimizer.settings')
 
 application = get_wsgi_application()
+
+# Only serving processes (including runserver's reloaded child) import this module, so
+# warm up here rather than in AppConfig.ready(), which every manage.py command runs
+from optimizer_api.utils.optimizer import warm_up  # noqa: E402
+
+warm_up()